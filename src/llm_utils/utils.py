@@ -1,26 +1,119 @@
 import re
 import json
 import textwrap
+import functools
+from itertools import islice
 from typing import Any, Dict, List, Tuple
 
 import tiktoken
 
 
+@functools.lru_cache(maxsize=64)
+def _extract_after_slash(s: str) -> str:
+    # Return the part after the first '/' if found, else return the whole string
+    _, sep, tail = s.partition("/")
+    return tail if sep else s
+
+
+# OpenAI specific.
+@functools.lru_cache(maxsize=32)
+def _get_encoding(model: str) -> tiktoken.Encoding:
+    """Returns the (cached) tiktoken encoding for the given model name, without any provider prefix."""
+    return tiktoken.encoding_for_model(model)
+
+
+# OpenAI specific.
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Returns the tiktoken encoding for a model, to be used with `count_tokens_fast`.
+
+    Args:
+        model (str): The model name, optionally prefixed with a provider (e.g., `openai/gpt-4`).
+
+    Returns:
+        The (cached) encoding for the model.
+
+    Raises:
+        KeyError: If the model is unknown to tiktoken.
+    """
+    return _get_encoding(_extract_after_slash(model))
+
+
+# OpenAI specific.
+def count_tokens_fast(encoding: tiktoken.Encoding, string: str) -> int:
+    """
+    Returns the number of tokens in a text string.
+
+    Unlike `count_tokens`, this takes an encoding obtained from `get_encoding`, so the
+    model lookup can be hoisted out of loops that count tokens for many strings.
+    """
+    return len(encoding.encode(string))
+
+
 # OpenAI specific.
 def count_tokens(model: str, string: str) -> int:
     """Returns the number of tokens in a text string."""
+    try:
+        return count_tokens_fast(get_encoding(model), string)
+    except KeyError:
+        return 0
 
-    def extract_after_slash(s: str) -> str:
-        # Split the string by '/' and return the part after it if '/' is found, else return the whole string
-        parts = s.split("/", 1)  # The '1' ensures we split at the first '/' only
-        return parts[1] if len(parts) > 1 else s
 
+# OpenAI specific.
+def count_tokens_batch(model: str, strings: List[str]) -> List[int]:
+    """
+    Returns the number of tokens in each of the given text strings.
+
+    Prefer this over calling `count_tokens` in a loop (e.g., over the messages
+    of a conversation): the strings are encoded in parallel in a single call.
+
+    Args:
+        model (str): The model name, optionally prefixed with a provider (e.g., `openai/gpt-4`).
+        strings (List[str]): The text strings to count tokens for.
+
+    Returns:
+        The number of tokens in each string, or 0 for each if the model is unknown.
+    """
     try:
-        encoding = tiktoken.encoding_for_model(extract_after_slash(model))
-        num_tokens = len(encoding.encode(string))
-        return num_tokens
+        encoding = get_encoding(model)
     except KeyError:
-        return 0
+        return [0] * len(strings)
+    return [len(tokens) for tokens in encoding.encode_batch(strings)]
+
+
+# OpenAI specific.
+# Latest pricing info from OpenAI (https://openai.com/pricing and
+# https://platform.openai.com/docs/deprecations/), as of March 5, 2024.
+# Maps model name to (input, output) price per million tokens.
+_PRICING_PER_MILLION: Dict[str, Tuple[float, float]] = {
+    # gpt-4-turbo.
+    "gpt-4-0125-preview": (10, 30),
+    "gpt-4-turbo-preview": (10, 30),
+    "gpt-4-1106-preview": (10, 30),
+    "gpt-4-vision-preview": (10, 30),
+    "gpt-4-1106-vision-preview": (10, 30),
+    # gpt-4.
+    "gpt-4": (30, 60),
+    "gpt-4-0613": (30, 60),
+    "gpt-4-32k": (60, 120),
+    "gpt-4-32k-0613": (60, 120),
+    # gpt-3.5-turbo.
+    "gpt-3.5-turbo-0125": (0.5, 1.5),
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-3.5-turbo-1106": (1, 2),
+    "gpt-3.5-turbo-instruct": (1.5, 2),
+    "gpt-3.5-turbo-16k": (3, 4),
+    "gpt-3.5-turbo-0613": (1.5, 2),
+    "gpt-3.5-turbo-16k-0613": (3, 4),
+}
+
+
+def _get_pricing(model_type: str) -> Tuple[float, float]:
+    if not (price_per_million := _PRICING_PER_MILLION.get(model_type)):
+        raise ValueError(
+            f'Unknown model "{model_type}". Choose from: {", ".join(m for m in _PRICING_PER_MILLION)}.'
+        )
+    return price_per_million
 
 
 # OpenAI specific.
@@ -38,39 +131,43 @@ def calculate_cost(
     Returns:
         The cost of processing the request, in USD.
     """
-    # Latest pricing info from OpenAI (https://openai.com/pricing and
-    # https://platform.openai.com/docs/deprecations/), as of March 5, 2024.
-    PRICING_PER_MILLION: Dict[str, Dict[str, float]] = {
-        # gpt-4-turbo.
-        "gpt-4-0125-preview": {"input": 10, "output": 30},
-        "gpt-4-turbo-preview": {"input": 10, "output": 30},
-        "gpt-4-1106-preview": {"input": 10, "output": 30},
-        "gpt-4-vision-preview": {"input": 10, "output": 30},
-        "gpt-4-1106-vision-preview": {"input": 10, "output": 30},
-        # gpt-4.
-        "gpt-4": {"input": 30, "output": 60},
-        "gpt-4-0613": {"input": 30, "output": 60},
-        "gpt-4-32k": {"input": 60, "output": 120},
-        "gpt-4-32k-0613": {"input": 60, "output": 120},
-        # gpt-3.5-turbo.
-        "gpt-3.5-turbo-0125": {"input": 0.5, "output": 1.5},
-        "gpt-3.5-turbo": {"input": 0.5, "output": 1.5},
-        "gpt-3.5-turbo-1106": {"input": 1, "output": 2},
-        "gpt-3.5-turbo-instruct": {"input": 1.5, "output": 2},
-        "gpt-3.5-turbo-16k": {"input": 3, "output": 4},
-        "gpt-3.5-turbo-0613": {"input": 1.5, "output": 2},
-        "gpt-3.5-turbo-16k-0613": {"input": 3, "output": 4},
-    }
-
-    if not (price_per_million := PRICING_PER_MILLION.get(model_type)):
-        raise ValueError(
-            f'Unknown model "{model_type}". Choose from: {", ".join(m for m in PRICING_PER_MILLION)}.'
-        )
-
+    input_price, output_price = _get_pricing(model_type)
     return (
-        num_input_tokens / 1_000_000 * price_per_million["input"]
-        + num_output_tokens / 1_000_000 * price_per_million["output"]
-    )
+        num_input_tokens * input_price + num_output_tokens * output_price
+    ) / 1_000_000
+
+
+# OpenAI specific.
+def calculate_cost_bulk(
+    num_input_tokens: List[int], num_output_tokens: List[int], model_types: List[str]
+) -> List[float]:
+    """
+    Calculate the cost of processing many requests at once.
+
+    Args:
+        num_input_tokens (List[int]): Number of input tokens for each request.
+        num_output_tokens (List[int]): Number of output tokens for each request.
+        model_types (List[str]): The type of GPT model used for each request.
+
+    Returns:
+        The cost of processing each request, in USD.
+    """
+    if not len(num_input_tokens) == len(num_output_tokens) == len(model_types):
+        raise ValueError("All arguments must have the same length.")
+
+    # Look up the pricing of each distinct model only once.
+    pricing = {m: _get_pricing(m) for m in set(model_types)}
+    return [
+        (i * pricing[m][0] + o * pricing[m][1]) / 1_000_000
+        for i, o, m in zip(num_input_tokens, num_output_tokens, model_types)
+    ]
+
+
+# A code block starts with a line beginning with ` ``` ` and runs up to and including
+# the next such line, or to the end of the text if it is never closed.
+_FENCED_BLOCK_RE = re.compile(r"(^```.*?(?:^```[^\n]*|\Z))", re.MULTILINE | re.DOTALL)
+
+_DEFAULT_WRAPPER = textwrap.TextWrapper(width=80)
 
 
 def word_wrap_except_code_blocks(text: str, width: int = 80) -> str:
@@ -83,63 +180,51 @@ def word_wrap_except_code_blocks(text: str, width: int = 80) -> str:
 
     Args:
         text (str): The text to wrap.
-        width (int): The width of the lines to wrap at, passed to `textwrap.fill`.
+        width (int): The width of the lines to wrap at, passed to `textwrap.TextWrapper`.
 
     Returns:
         The wrapped text.
     """
-    # Find code blocks.
-    blocks = []
-    is_code_block = []
-    block = []
-    in_code_block = False
-    for line in text.split("\n"):
-        if line.startswith("```"):
-            if in_code_block:
-                block.append(line)
-                blocks.append(block)
-                block = []
-            else:
-                blocks.append(block)
-                block = [line]
-            is_code_block.append(in_code_block)
-            in_code_block = not in_code_block
-        else:
-            block.append(line)
-    blocks.append(block)
-    is_code_block.append(in_code_block)
-
-    # Split text (non-code) paragraphs.
-    copied_blocks = []
-    copied_is_code_block = []
-    for i in range(len(blocks)):
-        if is_code_block[i]:
-            copied_blocks.append(blocks[i])
-            copied_is_code_block.append(True)
-        else:
-            block = []
-            for line in blocks[i]:
-                if not line:
-                    if block:
-                        copied_blocks.append(block)
-                        copied_is_code_block.append(False)
-                        block = []
-                else:
-                    block.append(line)
-            if block:
-                copied_blocks.append(block)
-                copied_is_code_block.append(False)
-                block = []
-    blocks = copied_blocks
-    is_code_block = copied_is_code_block
-
-    # Word wrap text blocks.
-    for i in range(len(blocks)):
-        if not is_code_block[i]:
-            blocks[i] = [textwrap.fill(l, width) for l in blocks[i]]
+    # `textwrap.fill` builds a new `TextWrapper` on every call, build (or reuse) a single one instead.
+    wrapper = (
+        _DEFAULT_WRAPPER
+        if width == _DEFAULT_WRAPPER.width
+        else textwrap.TextWrapper(width=width)
+    )
+
+    blocks: List[str] = []
+    for i, part in enumerate(_FENCED_BLOCK_RE.split(text)):
+        # Code blocks (odd indices) are kept verbatim.
+        if i % 2:
+            blocks.append(part)
+            continue
+
+        # Split text (non-code) into paragraphs and word wrap each line.
+        paragraph: List[str] = []
+        for line in part.split("\n"):
+            if line:
+                paragraph.append(wrapper.fill(line))
+            elif paragraph:
+                blocks.append("\n".join(paragraph))
+                paragraph = []
+        if paragraph:
+            blocks.append("\n".join(paragraph))
 
     # Join lines with a single newline, blocks with two newlines.
-    return "\n\n".join(["\n".join(b) for b in blocks])
+    return "\n\n".join(blocks)
+
+
+_READ_BUFFER_SIZE = 64 * 1024
+
+# Prevent pathological case where lines are REALLY long.
+_MAX_CHARS_PER_LINE = 128
+
+
+def _truncate(s: str) -> str:
+    """
+    Truncate the string to at most `_MAX_CHARS_PER_LINE` characters, adding ellipses if truncated.
+    """
+    return s if len(s) < _MAX_CHARS_PER_LINE else s[:_MAX_CHARS_PER_LINE] + "..."
 
 
 def read_lines(file_path: str, start_line: int, end_line: int) -> Tuple[List[str], int]:
@@ -157,27 +242,22 @@ def read_lines(file_path: str, start_line: int, end_line: int) -> Tuple[List[str
     Raises:
         FileNotFoundError: If the file does not exist.
     """
-    # Prevent pathological case where lines are REALLY long.
-    max_chars_per_line = 128
-
-    def truncate(s: str, l: int) -> str:
-        """
-        Truncate the string to at most the given length, adding ellipses if truncated.
-        """
-        if len(s) < l:
-            return s
-        else:
-            return s[:l] + "..."
-
-    with open(file_path, "r") as f:
-        lines = f.readlines()
-        lines = [truncate(line.rstrip(), max_chars_per_line) for line in lines]
-
-    # Ensure indices are in range.
+    # Ensure indices are in range. The upper bound is enforced by islice
+    # stopping at the end of the file.
     start_line = max(1, start_line)
-    end_line = min(len(lines), end_line)
+    end_line = max(start_line - 1, end_line)
+
+    # Only read as far as the last requested line. Use larger reads than the
+    # 8 KiB default to cut down on syscalls on high-latency (e.g., network)
+    # file systems.
+    with open(file_path, "r", buffering=_READ_BUFFER_SIZE) as f:
+        if hasattr(f, "_CHUNK_SIZE"):
+            f._CHUNK_SIZE = _READ_BUFFER_SIZE
+        lines = [
+            _truncate(line.rstrip()) for line in islice(f, start_line - 1, end_line)
+        ]
 
-    return (lines[start_line - 1 : end_line], start_line)
+    return (lines, start_line)
 
 
 def number_group_of_lines(group: List[str], first: int, strip: bool = True) -> str:
@@ -193,42 +273,48 @@ def number_group_of_lines(group: List[str], first: int, strip: bool = True) -> s
         A string concatenation of the numbered lines.
     """
     if strip:
-        while group and not group[0].strip():
-            group = group[1:]
-            first += 1
-        while group and not group[-1].strip():
-            group = group[:-1]
+        lo = 0
+        while lo < len(group) and not group[lo].strip():
+            lo += 1
+        hi = len(group)
+        while hi > lo and not group[hi - 1].strip():
+            hi -= 1
+        first += lo
+        group = group[lo:hi]
 
     last = first + len(group) - 1
     max_line_number_length = len(str(last))
-    result = "\n".join(
-        [
-            "{0:>{1}} {2}".format(first + i, max_line_number_length, line)
-            for i, line in enumerate(group)
-        ]
-    )
+    fmt = "{0:>" + str(max_line_number_length) + "} {1}"
+    result = "\n".join([fmt.format(first + i, line) for i, line in enumerate(group)])
     return result
 
 
+_TRIPLE_QUOTE_RE = re.compile(r'"""(.*?)"""', re.DOTALL)
+
+
 def contains_valid_json(my_string: str) -> Any:
     """
     Parses JSON if valid, replacing any triple quotes with single quotes.
     Returns the parsed JSON blob if successful, None if not.
     """
 
-    # Find start and end position of possible JSON string
+    # Find start and end position of possible JSON string,
+    # there is no JSON object if either is missing
     start_pos = my_string.find("{")
+    if start_pos == -1:
+        return None
     end_pos = my_string.rfind("}") + 1
-
-    # There is no JSON object if start or end position is -1
-    if start_pos == -1 or end_pos == 0:
+    if end_pos == 0:
         return None
 
     json_string = my_string[start_pos:end_pos]
-    pattern = r'"""(.*?)"""'
-    processed_string = re.sub(
-        pattern, lambda m: json.dumps(m.group(1)), json_string, flags=re.DOTALL
-    )
+    # Skip the regex pass entirely in the common case of no triple quotes.
+    if '"""' in json_string:
+        processed_string = _TRIPLE_QUOTE_RE.sub(
+            lambda m: json.dumps(m.group(1)), json_string
+        )
+    else:
+        processed_string = json_string
     # processed_string = json_string.sub(r'"""', r'\"\"\"')
     try:
         return json.loads(processed_string, strict=False)
@@ -239,9 +325,11 @@ def contains_valid_json(my_string: str) -> Any:
         return None
 
 
+_CODE_BLOCK_RE = re.compile(r"```(python)?(.*?)```", re.DOTALL)
+
+
 def extract_code_blocks(text: str) -> List[str]:
-    pattern = r"```(python)?(.*?)```"
-    blocks = re.findall(pattern, text, re.DOTALL)
+    blocks = _CODE_BLOCK_RE.findall(text)
     return [block[1].strip() for block in blocks]
 
 
@@ -251,7 +339,6 @@ def parse_chatlog(log: str) -> List[Dict[str, str]]:
     for entry in entries:
         if not entry.strip():  # ignore empty entries
             continue
-        role, *content = entry.split(": ", 1)
-        content_str = content[0] if content else ""
-        result.append({"role": role, "content": content_str})
+        role, _, content = entry.partition(": ")
+        result.append({"role": role, "content": content})
     return result
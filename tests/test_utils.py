@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 
 import llm_utils
@@ -22,6 +24,24 @@ class TestCalculateCost(unittest.TestCase):
         )
         self.assertRaises(ValueError, llm_utils.calculate_cost, 0, 0, "not-an-llm")
 
+    def test_calculate_cost_bulk(self):
+        self.assertEqual(llm_utils.calculate_cost_bulk([], [], []), [])
+        costs = llm_utils.calculate_cost_bulk(
+            [1000, 1000, 10000],
+            [2000, 2000, 2000],
+            ["gpt-3.5-turbo", "gpt-4", "gpt-4-1106-preview"],
+        )
+        self.assertEqual(len(costs), 3)
+        self.assertAlmostEqual(costs[0], 0.0035)
+        self.assertAlmostEqual(costs[1], 0.15)
+        self.assertAlmostEqual(costs[2], 0.16)
+        self.assertRaises(
+            ValueError, llm_utils.calculate_cost_bulk, [0], [0], ["not-an-llm"]
+        )
+        self.assertRaises(
+            ValueError, llm_utils.calculate_cost_bulk, [0, 0], [0], ["gpt-4"]
+        )
+
 
 class TestWordWrap(unittest.TestCase):
     def test_word_wrap_except_code_blocks(self):
@@ -97,6 +117,35 @@ class TestWordWrap(unittest.TestCase):
             "```",
         )
 
+        self.assertEqual(
+            llm_utils.word_wrap_except_code_blocks(
+                "Blank lines inside code blocks should be kept.\n"
+                "```\n"
+                "a = 1\n"
+                "\n"
+                "\n"
+                "b = 2\n"
+                "```\n"
+                "\n"
+                "\n"
+                "Done."
+            ),
+            "Blank lines inside code blocks should be kept.\n"
+            "\n"
+            "```\n"
+            "a = 1\n"
+            "\n"
+            "\n"
+            "b = 2\n"
+            "```\n"
+            "\n"
+            "Done.",
+        )
+        self.assertEqual(
+            llm_utils.word_wrap_except_code_blocks("Unclosed:\n```\na\n\nb\n"),
+            "Unclosed:\n\n```\na\n\nb\n",
+        )
+
 
 class TestNumberGroupOfLines(unittest.TestCase):
     def test_with_strip(self):
@@ -145,5 +194,78 @@ class TestNumberGroupOfLines(unittest.TestCase):
         )
 
 
+class TestReadLines(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as f:
+            f.write("one\ntwo  \nthree\n" + "x" * 200 + "\nfive")
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_read_lines(self):
+        self.assertEqual(llm_utils.read_lines(self.path, 1, 2), (["one", "two"], 1))
+        self.assertEqual(llm_utils.read_lines(self.path, 2, 3), (["two", "three"], 2))
+        self.assertEqual(
+            llm_utils.read_lines(self.path, -5, 1),
+            (["one"], 1),
+        )
+        self.assertEqual(
+            llm_utils.read_lines(self.path, 4, 100),
+            (["x" * 128 + "...", "five"], 4),
+        )
+        self.assertEqual(llm_utils.read_lines(self.path, 10, 20), ([], 10))
+        self.assertEqual(llm_utils.read_lines(self.path, 3, 2), ([], 3))
+        self.assertRaises(
+            FileNotFoundError, llm_utils.read_lines, self.path + ".missing", 1, 2
+        )
+
+
+class TestContainsValidJson(unittest.TestCase):
+    def test_contains_valid_json(self):
+        self.assertIsNone(llm_utils.contains_valid_json(""))
+        self.assertIsNone(llm_utils.contains_valid_json("no json here"))
+        self.assertIsNone(llm_utils.contains_valid_json("} {"))
+        self.assertIsNone(llm_utils.contains_valid_json("{not: json}"))
+        self.assertEqual(llm_utils.contains_valid_json("{}"), {})
+        self.assertEqual(
+            llm_utils.contains_valid_json('Here you go: {"a": [1, 2]} Enjoy!'),
+            {"a": [1, 2]},
+        )
+        self.assertEqual(
+            llm_utils.contains_valid_json(
+                '{"code": """def f():\n    return "x"\n""", "b": """y"""}'
+            ),
+            {"code": 'def f():\n    return "x"\n', "b": "y"},
+        )
+
+
+class TestExtractCodeBlocks(unittest.TestCase):
+    def test_extract_code_blocks(self):
+        self.assertEqual(llm_utils.extract_code_blocks("no code"), [])
+        self.assertEqual(
+            llm_utils.extract_code_blocks(
+                "First:\n```python\na = 1\n```\nSecond:\n```\nb = 2\n```"
+            ),
+            ["a = 1", "b = 2"],
+        )
+
+
+class TestParseChatlog(unittest.TestCase):
+    def test_parse_chatlog(self):
+        self.assertEqual(llm_utils.parse_chatlog(""), [])
+        self.assertEqual(
+            llm_utils.parse_chatlog("user: Hi: there.\n\n\n\nassistant: Hello!"),
+            [
+                {"role": "user", "content": "Hi: there."},
+                {"role": "assistant", "content": "Hello!"},
+            ],
+        )
+        self.assertEqual(
+            llm_utils.parse_chatlog("system\n\n  \n\nuser: "),
+            [{"role": "system", "content": ""}, {"role": "user", "content": ""}],
+        )
+
+
 if __name__ == "__main__":
     unittest.main()